@@ -1,11 +1,22 @@
-from flask import Flask, render_template, request
+from flask import Flask, g, has_request_context, render_template, request, stream_template
 from flask import jsonify
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import click
 from markupsafe import Markup
 import duckdb
+import numpy as np
 import pandas as pd
 import plotly.express as px
+import plotly.graph_objects as go
 import plotly.io as pio
+import fcntl
+import json
 import os
+import shutil
+import threading
+import time
 
 app = Flask(__name__)
 
@@ -59,39 +70,308 @@ if _env_db:
 else:
   DB_PATH = os.path.join(os.path.dirname(__file__), '..', 'final_instacart.db')
 
-# Create a reusable connection function
-def get_con():
-    # if DB_PATH file exists use it, else default to in-memory
-  if os.path.exists(DB_PATH):
-    return duckdb.connect(database=DB_PATH)
-  return duckdb.connect(database=':memory:')
+# --- Versioned snapshots ---
+# The app only ever serves immutable copies, never the file an ingest job writes to.
+# `flask --app app publish-snapshot NEW.db` copies a finished database into SNAPSHOT_DIR as
+# `<version>.db` and then atomically replaces the `CURRENT` pointer. Each worker polls the
+# pointer, warms the new snapshot in the background and switches over; the old snapshot stops
+# taking new requests and closes its connection once the requests still using it finish.
+# On first start without a pointer, DB_PATH is published once (under a file lock shared by all
+# workers and the CLI) as the first snapshot.
+SNAPSHOT_DIR = os.path.expanduser(os.getenv('INSTACART_SNAPSHOT_DIR') or os.path.join(os.path.dirname(DB_PATH), 'snapshots'))
+SNAPSHOT_POINTER = os.path.join(SNAPSHOT_DIR, 'CURRENT')
+SNAPSHOT_POLL_SECONDS = float(os.getenv('INSTACART_SNAPSHOT_POLL_SECONDS', '2'))
+SNAPSHOT_KEEP = int(os.getenv('INSTACART_SNAPSHOT_KEEP', '3'))
+SNAPSHOT_RETRY_MAX_SECONDS = 60
 
-@app.route('/')
-def index():
-    # Render the general introduction dashboard as the main page
-    return general_dashboard()
 
+class Snapshot:
+  """One immutable database version and the requests currently holding it.
 
-@app.route('/general_dashboard')
-def general_dashboard():
-    con = get_con()
-    # Q1
-    q1 = """
+  The snapshot opens a single read-only connection and hands out cursors, so its file stays
+  readable after a newer publish removes it. Once retired it refuses new holds, closes the
+  connection when the last holder releases it, and cannot be connected to again.
+  """
+
+  def __init__(self, version, path):
+    self.version = version
+    self.path = path
+    self._lock = threading.Lock()
+    self._con = None
+    self._holders = 0
+    self._retired = False
+    self._drained = threading.Event()
+    self._drained.set()
+
+  def connect(self):
+    with self._lock:
+      if self._retired and self._holders == 0:
+        # never reopen a drained snapshot; its file may already be pruned
+        raise RuntimeError(f'snapshot {self.version} is retired')
+      if self._con is None:
+        # read-only so serving never takes the write lock an ingest job might need
+        if self.path is None:
+          self._con = duckdb.connect(database=':memory:')
+        else:
+          self._con = duckdb.connect(database=self.path, read_only=True)
+    return self._con.cursor()
+
+  def hold(self):
+    """Register a holder; returns False once the snapshot has been retired."""
+    with self._lock:
+      if self._retired:
+        return False
+      self._holders += 1
+      self._drained.clear()
+      return True
+
+  def share(self):
+    """Add a holder on behalf of an existing one (e.g. a streamed response that outlives its view)."""
+    with self._lock:
+      assert self._holders > 0, 'share() needs an existing holder'
+      self._holders += 1
+
+  def release(self):
+    with self._lock:
+      self._holders -= 1
+      if self._holders == 0:
+        self._drained.set()
+
+  def retire(self, warn_after=300):
+    """Refuse new holders, wait for the current ones to finish, then close the connection."""
+    with self._lock:
+      self._retired = True
+    while not self._drained.wait(warn_after):
+      app.logger.warning('Snapshot %s still has requests in flight', self.version)
+    with self._lock:
+      if self._con is not None:
+        self._con.close()
+        self._con = None
+
+
+def _read_snapshot_pointer():
+  """Return (version, path) of the published snapshot, or None if nothing is published yet."""
+  try:
+    with open(SNAPSHOT_POINTER) as fh:
+      version = fh.read().strip()
+  except FileNotFoundError:
+    return None
+  path = os.path.join(SNAPSHOT_DIR, f'{version}.db')
+  return (version, path) if version and os.path.exists(path) else None
+
+
+_snapshot = None
+_snapshot_lock = threading.Lock()
+_snapshot_checked_at = 0.0
+_snapshot_pending = None  # version being warmed in the background
+_snapshot_failed = {}     # version -> (failures, monotonic time of the next attempt)
+
+
+def _activate_snapshot(new):
+  """Warm `new`, make it current and retire the previous snapshot."""
+  global _snapshot, _snapshot_pending
+  try:
+    new.connect().close()
+    get_demand_cube(new)
+  except Exception:
+    with _snapshot_lock:
+      failures = _snapshot_failed.get(new.version, (0, 0))[0] + 1
+      delay = min(SNAPSHOT_POLL_SECONDS * 2 ** failures, SNAPSHOT_RETRY_MAX_SECONDS)
+      _snapshot_failed[new.version] = (failures, time.monotonic() + delay)
+      _snapshot_pending = None
+    app.logger.exception('Could not warm snapshot %s (attempt %d, retrying in %.0fs); still serving %s',
+                         new.version, failures, delay, _snapshot and _snapshot.version)
+    return
+  with _snapshot_lock:
+    _snapshot_pending = None
+    _snapshot_failed.pop(new.version, None)
+    # a newer publish may have landed while we warmed; never switch to anything but the
+    # pointer's target, and never back to an older version
+    target = _read_snapshot_pointer()
+    stale = target is None or target[0] != new.version or (_snapshot is not None and new.version < _snapshot.version)
+    if not stale:
+      old, _snapshot = _snapshot, new
+  if stale:
+    app.logger.info('Dropping snapshot %s; CURRENT now points at %s', new.version, target and target[0])
+    new.retire()
+    return
+  app.logger.info('Switched to snapshot %s', new.version)
+  if old is not None:
+    old.retire()
+
+
+def get_snapshot():
+  """Return the snapshot new requests should use, noticing pointer changes at most every poll interval."""
+  global _snapshot, _snapshot_checked_at, _snapshot_pending
+  now = time.monotonic()
+  if _snapshot is not None and now - _snapshot_checked_at < SNAPSHOT_POLL_SECONDS:
+    return _snapshot
+  if (_snapshot is None or _snapshot.path is None) and not os.path.exists(SNAPSHOT_POINTER) and os.path.exists(DB_PATH):
+    # first start: publish DB_PATH once, outside the snapshot lock; the publish lock makes
+    # concurrent workers agree on a single copy
+    try:
+      publish_snapshot(DB_PATH, if_missing=True)
+    except Exception:
+      app.logger.exception('Could not publish %s as the first snapshot; will retry', DB_PATH)
+  with _snapshot_lock:
+    if _snapshot is not None and now - _snapshot_checked_at < SNAPSHOT_POLL_SECONDS:
+      return _snapshot
+    _snapshot_checked_at = now
+    target = _read_snapshot_pointer()
+    current = _snapshot
+    if target is None:
+      # a missing file is never a reason to drop the data we are already serving
+      if current is None:
+        _snapshot = Snapshot('empty', None)
+      return _snapshot
+    if current is None or current.path is None:
+      # nothing real served yet, so nothing to warm or drain; open it before it becomes
+      # current so a later prune cannot remove it under us
+      new = Snapshot(*target)
+      try:
+        new.connect().close()
+      except Exception:
+        app.logger.exception('Could not open snapshot %s; will retry', new.version)
+        new = current or Snapshot('empty', None)
+      _snapshot = new
+      return _snapshot
+    version = target[0]
+    failures, retry_at = _snapshot_failed.get(version, (0, 0))
+    # one warm at a time, so switches happen in publish order; a version published meanwhile
+    # is picked up by the first poll after the running warm finishes
+    if version == current.version or _snapshot_pending is not None or now < retry_at:
+      return current
+    _snapshot_pending = version
+  new = Snapshot(*target)
+  threading.Thread(target=_activate_snapshot, args=(new,), name=f'snapshot-{new.version}', daemon=True).start()
+  return current
+
+
+def _checkout_snapshot():
+  # a snapshot retired between get_snapshot() and hold() has been replaced already; retry
+  while True:
+    snapshot = get_snapshot()
+    if snapshot.hold():
+      return snapshot
+
+
+@contextmanager
+def held_snapshot():
+  """Hold the current snapshot for the duration of the block (for work outside a request)."""
+  snapshot = _checkout_snapshot()
+  try:
+    yield snapshot
+  finally:
+    snapshot.release()
+
+
+def request_snapshot():
+  """Return the snapshot for this request, chosen once and held until the response finishes.
+
+  Every query in a request (including streamed dashboard panels) reads the same data version.
+  """
+  if 'snapshot' not in g:
+    g.snapshot = _checkout_snapshot()
+  return g.snapshot
+
+
+@app.teardown_request
+def _release_request_snapshot(exc):
+  snapshot = g.pop('snapshot', None)
+  if snapshot is not None:
+    snapshot.release()
+
+
+@contextmanager
+def _publish_lock():
+  # serialises publishes across processes (gunicorn workers and the CLI)
+  os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+  with open(os.path.join(SNAPSHOT_DIR, '.publish.lock'), 'w') as fh:
+    fcntl.flock(fh, fcntl.LOCK_EX)
+    yield
+
+
+def publish_snapshot(source, keep=SNAPSHOT_KEEP, if_missing=False):
+  """Copy a finished DuckDB file into SNAPSHOT_DIR and point CURRENT at it. Returns the version.
+
+  With `if_missing`, publish only if nothing has been published yet and return None otherwise,
+  so workers starting together publish DB_PATH exactly once between them.
+  """
+  if os.path.exists(source + '.wal'):
+    raise RuntimeError(f'{source} has an un-checkpointed WAL; close the writer (or run CHECKPOINT) first')
+  with _publish_lock():
+    if if_missing and os.path.exists(SNAPSHOT_POINTER):
+      return None
+    version = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%fZ')
+    target = os.path.join(SNAPSHOT_DIR, f'{version}.db')
+    shutil.copyfile(source, target + '.tmp')
+    with open(target + '.tmp', 'rb') as fh:
+      os.fsync(fh.fileno())
+    os.replace(target + '.tmp', target)
+    with open(SNAPSHOT_POINTER + '.tmp', 'w') as fh:
+      fh.write(version + '\n')
+      fh.flush()
+      os.fsync(fh.fileno())
+    os.replace(SNAPSHOT_POINTER + '.tmp', SNAPSHOT_POINTER)
+
+    # retire old versions; workers that still serve one keep it open, and an unlinked file
+    # stays readable until they switch
+    versions = sorted(f[:-3] for f in os.listdir(SNAPSHOT_DIR) if f.endswith('.db'))
+    for old in versions[:-keep] if keep > 0 else []:
+      try:
+        os.remove(os.path.join(SNAPSHOT_DIR, f'{old}.db'))
+      except OSError:
+        pass  # still open somewhere on a platform that refuses to unlink; retry next publish
+    return version
+
+
+@app.cli.command('publish-snapshot')
+@click.argument('source', type=click.Path(exists=True, dir_okay=False))
+@click.option('--keep', default=SNAPSHOT_KEEP, show_default=True, help='Number of snapshots to retain.')
+def publish_snapshot_command(source, keep):
+  """Publish SOURCE as the database every worker serves next."""
+  version = publish_snapshot(source, keep=max(keep, 1))
+  click.echo(f'Published snapshot {version} to {SNAPSHOT_DIR}')
+
+
+# --- Query catalog ---
+# Every route reads through `run_query(name)` so the same SQL is defined once and identical
+# concurrent requests can be coalesced.
+QUERIES = {
+  # Q1: products and departments with the highest repeat-purchase rates (dashboard + API)
+  'q1_top_reorder_products': """
     SELECT
-      p.product_name, d.department, COUNT(*) AS total_items,
+      p.product_id, p.product_name, d.department, a.aisle, COUNT(*) AS total_items,
       AVG(CASE WHEN f.reordered = 1 THEN 1.0 ELSE 0.0 END) AS reorder_rate
     FROM fact_order_products f
     JOIN dim_product p    ON f.product_id = p.product_id
     JOIN dim_department d ON p.department_id = d.department_id
-    GROUP BY p.product_name, d.department
+    JOIN dim_aisles a ON a.aisle_id = p.aisle_id
+    GROUP BY p.product_id, p.product_name, d.department, a.aisle
     HAVING COUNT(*) > 100
     ORDER BY reorder_rate DESC, total_items DESC
-    LIMIT 100;
-    """
-    q1_df = con.execute(q1).fetchdf()
-
-    # Q2 day and hour
-    q2_day = """
+    LIMIT 20;
+    """,
+  # Q1 page: reorder rate for products with at least 50 orders
+  'q1_reorder_stats': """
+    WITH product_stats AS (
+      SELECT p.product_name, d.department,
+             COUNT(*) AS total_orders,
+             SUM(op.reordered) AS total_reorders,
+             SUM(op.reordered)::DOUBLE / NULLIF(COUNT(*),0) AS reorder_rate
+      FROM fact_order_products op
+      JOIN dim_product p ON op.product_id = p.product_id
+      JOIN dim_department d ON p.department_id = d.department_id
+      GROUP BY 1,2
+      HAVING COUNT(*) >= 50
+    )
+    SELECT product_name, department, reorder_rate, total_orders
+    FROM product_stats
+    ORDER BY reorder_rate DESC
+    LIMIT 20;
+    """,
+  # Q2: items ordered per day of week
+  'q2_items_by_day': """
     SELECT 
       o.order_dow AS day_of_week,
       CASE 
@@ -109,8 +389,9 @@ def general_dashboard():
       ON f.order_id = o.order_id
     GROUP BY o.order_dow
     ORDER BY o.order_dow;
-    """
-    q2_hour = """
+    """,
+  # Q2: items ordered per hour of day
+  'q2_items_by_hour': """
     SELECT
       o.order_hour_of_day AS hour_of_day,
       COUNT(*) AS total_items
@@ -118,128 +399,528 @@ def general_dashboard():
     JOIN dim_order o ON f.order_id = o.order_id
     GROUP BY o.order_hour_of_day
     ORDER BY o.order_hour_of_day;
-    """
-    q2_day_df = con.execute(q2_day).fetchdf()
-    q2_hour_df = con.execute(q2_hour).fetchdf()
-
-    # Q3
-    q3 = """
+    """,
+  # Q3: pairs among the 100 most-ordered products that are bought together (dashboard + API)
+  'q3_top_pairs': """
     WITH top_products AS (
-      SELECT product_id, COUNT(*) AS total_items
+      SELECT
+        product_id,
+        COUNT(*) AS total_items
       FROM fact_order_products
       GROUP BY product_id
       ORDER BY total_items DESC
       LIMIT 100
-    ), filtered AS (
-      SELECT f.order_id, f.product_id
+    ),
+    filtered AS (
+      SELECT
+        f.order_id,
+        f.product_id
       FROM fact_order_products f
       JOIN top_products t USING (product_id)
     )
-    SELECT p1.product_name AS product_A, p2.product_name AS product_B, COUNT(*) AS times_bought_together
+    SELECT
+      p1.product_name AS product_A,
+      p2.product_name AS product_B,
+      COUNT(*) AS times_bought_together
     FROM filtered f1
     JOIN filtered f2
-      ON f1.order_id = f2.order_id AND f1.product_id < f2.product_id
+        ON f1.order_id = f2.order_id
+       AND f1.product_id < f2.product_id
     JOIN dim_product p1 ON f1.product_id = p1.product_id
     JOIN dim_product p2 ON f2.product_id = p2.product_id
     GROUP BY product_A, product_B
     ORDER BY times_bought_together DESC
     LIMIT 20;
-    """
-    q3_df = con.execute(q3).fetchdf()
-
-    # Q4
-    q4 = """
+    """,
+  # Q3 page: co-purchased pairs across all products
+  'q3_all_pairs': """
+    WITH pairs AS (
+      SELECT LEAST(p1.product_name, p2.product_name) AS product_a,
+             GREATEST(p1.product_name, p2.product_name) AS product_b,
+             COUNT(*) AS pair_count
+      FROM fact_order_products op1
+      JOIN fact_order_products op2
+        ON op1.order_id = op2.order_id
+       AND op1.product_id < op2.product_id
+      JOIN dim_product p1 ON op1.product_id = p1.product_id
+      JOIN dim_product p2 ON op2.product_id = p2.product_id
+      GROUP BY 1,2
+    )
+    SELECT *
+    FROM pairs
+    ORDER BY pair_count DESC
+    LIMIT 50;
+    """,
+  # Q4: reorder rate by order-frequency segment (dashboard + API)
+  'q4_frequency_segments': """
     WITH customer_stats AS (
       SELECT user_id, AVG(days_since_prior_order) AS avg_days_between_orders, COUNT(order_id) AS total_orders
       FROM dim_order
       WHERE days_since_prior_order IS NOT NULL
       GROUP BY user_id
-    ), segments AS (
-      SELECT user_id, avg_days_between_orders, total_orders,
-        CASE WHEN avg_days_between_orders <= 7 THEN 'High-frequency'
-             WHEN avg_days_between_orders BETWEEN 8 AND 20 THEN 'Medium-frequency'
-             ELSE 'Low-frequency' END AS customer_segment
+    ),
+    segments AS (
+      SELECT
+        user_id, avg_days_between_orders, total_orders,
+        CASE
+          WHEN avg_days_between_orders <= 7 THEN 'High-frequency'
+          WHEN avg_days_between_orders BETWEEN 8 AND 20 THEN 'Medium-frequency'
+          ELSE 'Low-frequency'
+        END AS customer_segment
       FROM customer_stats
     )
-    SELECT s.customer_segment, COUNT(DISTINCT s.user_id) AS num_customers, AVG(f.reordered) AS avg_reorder_rate
+    SELECT
+      s.customer_segment, COUNT(DISTINCT s.user_id) AS num_customers, AVG(f.reordered) AS avg_reorder_rate,
+      AVG(s.avg_days_between_orders) AS avg_days_between_orders
     FROM segments s
-    JOIN dim_order o ON o.user_id = s.user_id
-    JOIN fact_order_products f ON f.order_id = o.order_id
+    JOIN dim_order o             ON o.user_id = s.user_id
+    JOIN fact_order_products f   ON f.order_id = o.order_id
     GROUP BY s.customer_segment
     ORDER BY avg_reorder_rate DESC;
-    """
-    q4_df = con.execute(q4).fetchdf()
+    """,
+  # Q4 page: reorder rate by basket-size segment
+  'q4_basket_segments': """
+    WITH order_sizes AS (
+      SELECT o.user_id, o.order_id, COUNT(*) AS basket_size
+      FROM dim_order o
+      JOIN fact_order_products op ON o.order_id = op.order_id
+      GROUP BY 1,2
+    ),
+    user_segments AS (
+      SELECT user_id, AVG(basket_size) AS avg_basket,
+             CASE WHEN AVG(basket_size) < 8 THEN 'small'
+                  WHEN AVG(basket_size) BETWEEN 8 AND 15 THEN 'medium'
+                  ELSE 'large' END AS segment
+      FROM order_sizes
+      GROUP BY 1
+    ),
+    user_reorder AS (
+      SELECT u.segment, COUNT(*) AS total_items, SUM(op.reordered) AS total_reorders,
+             SUM(op.reordered)::DOUBLE / NULLIF(COUNT(*),0) AS reorder_rate
+      FROM user_segments u
+      JOIN dim_order o ON u.user_id = o.user_id
+      JOIN fact_order_products op ON o.order_id = op.order_id
+      GROUP BY 1
+    )
+    SELECT * FROM user_reorder ORDER BY segment;
+    """,
+  # Q5: days between orders, overall and by day / hour
+  'q5_recency': """
+    WITH recency AS (
+      SELECT user_id, order_id, order_number, days_since_prior_order
+      FROM dim_order
+      WHERE days_since_prior_order IS NOT NULL
+    ),
+    summary AS (
+      SELECT AVG(days_since_prior_order) AS avg_days, MEDIAN(days_since_prior_order) AS median_days FROM recency
+    ),
+    by_dow AS (
+      SELECT order_dow, AVG(days_since_prior_order) AS avg_days FROM dim_order WHERE days_since_prior_order IS NOT NULL GROUP BY order_dow
+    ),
+    by_hour AS (
+      SELECT order_hour_of_day, AVG(days_since_prior_order) AS avg_days FROM dim_order WHERE days_since_prior_order IS NOT NULL GROUP BY order_hour_of_day
+    )
+    SELECT 'overall' AS slice, * FROM summary
+    UNION ALL
+    SELECT 'by_dow:' || order_dow AS slice, avg_days AS avg_days, NULL AS median_days FROM by_dow
+    UNION ALL
+    SELECT 'by_hour:' || order_hour_of_day AS slice, avg_days AS avg_days, NULL AS median_days FROM by_hour
+    ORDER BY slice;
+    """,
+  # Demand cube dimensions
+  'departments': """
+    SELECT department_id, department FROM dim_department ORDER BY department_id;
+    """,
+  'aisles': """
+    SELECT aisle_id, aisle FROM dim_aisles ORDER BY aisle_id;
+    """,
+  # Demand cube cells. GROUPING SETS give the per-aisle cells plus the department and overall
+  # distinct-order counts, which cannot be summed from the cells (an order spanning two aisles
+  # would be counted twice).
+  'demand_cube': """
+    SELECT
+      p.department_id, p.aisle_id, o.order_dow, o.order_hour_of_day,
+      GROUPING(p.department_id, p.aisle_id) AS grp,
+      COUNT(*) AS items,
+      COUNT(DISTINCT f.order_id) AS orders
+    FROM fact_order_products f
+    JOIN dim_order o   ON f.order_id = o.order_id
+    JOIN dim_product p ON f.product_id = p.product_id
+    GROUP BY GROUPING SETS (
+      (p.department_id, p.aisle_id, o.order_dow, o.order_hour_of_day),
+      (p.department_id, o.order_dow, o.order_hour_of_day),
+      (o.order_dow, o.order_hour_of_day)
+    );
+    """,
+}
 
-    con.close()
 
-    # Build Plotly figures for each panel and return embedded HTML fragments
-    figs = {}
-    # Q1: top 10 products by reorder_rate
-    if not q1_df.empty:
-        q1_plot = q1_df.sort_values('reorder_rate', ascending=False).head(10)
-        fig1 = px.bar(q1_plot, x='reorder_rate', y='product_name', orientation='h', color='department', title='Top 10 products by repeat purchase rate')
-        figs['q1'] = pio.to_html(fig1, full_html=False, include_plotlyjs=False)
-    else:
-        figs['q1'] = '<div class="alert alert-warning">No data for Q1</div>'
+class SingleFlight:
+  """Coalesce concurrent calls that share a key into one execution.
+
+  The first caller for a key runs the function; callers arriving while it is still
+  running wait for and share its result (or exception). Nothing is kept afterwards.
+  """
 
-    # Q2 day
-    if not q2_day_df.empty:
-        fig2d = px.bar(q2_day_df, x='day_name', y='total_items', title='Ordering activity by day of week')
-        figs['q2_day'] = pio.to_html(fig2d, full_html=False, include_plotlyjs=False)
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._calls = {}
+
+  def do(self, key, fn):
+    with self._lock:
+      future = self._calls.get(key)
+      leader = future is None
+      if leader:
+        future = self._calls[key] = Future()
+    if leader:
+      try:
+        future.set_result(fn())
+      except BaseException as exc:
+        future.set_exception(exc)
+      finally:
+        with self._lock:
+          del self._calls[key]
+    return future.result()
+
+
+_query_flight = SingleFlight()
+
+
+def run_query(name, snapshot=None, **params):
+  """Run a catalog query and return a DataFrame the caller is free to modify.
+
+  Runs on the given snapshot, else the request's snapshot, else the current one. Keyword
+  arguments are bound as DuckDB named parameters (`$name`) and, together with the snapshot
+  version, form the coalescing key.
+  """
+  if snapshot is None:
+    if has_request_context():
+      snapshot = request_snapshot()
     else:
-        figs['q2_day'] = '<div class="alert alert-warning">No data for Q2 (day)</div>'
+      with held_snapshot() as snapshot:
+        return run_query(name, snapshot, **params)
+  sql = QUERIES[name]
+  key = (snapshot.version, name, tuple(sorted(params.items())))
+
+  def execute():
+    con = snapshot.connect()
+    try:
+      return (con.execute(sql, params) if params else con.execute(sql)).fetchdf()
+    finally:
+      con.close()
+
+  # callers share one frame from the in-flight execution; hand each its own copy
+  return _query_flight.do(key, execute).copy()
+
+
+# --- Demand cube: department x aisle x day-of-week x hour ---
+DAY_NAMES = ['Sunday', 'Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday']
+
+class DemandCube:
+  """Dense in-memory item/order counts indexed [department, aisle, dow, hour].
+
+  `items` is additive and can be rolled up along any axis. `orders` counts distinct
+  orders, so it is only exact for a single aisle, a single department or everything;
+  the department and overall grids are stored separately for that reason.
+  """
+
+  DIMENSIONS = ('department', 'aisle', 'dow', 'hour')
 
-    # Q2 hour
-    if not q2_hour_df.empty:
-        fig2h = px.line(q2_hour_df, x='hour_of_day', y='total_items', title='Ordering activity by hour of day')
-        figs['q2_hour'] = pio.to_html(fig2h, full_html=False, include_plotlyjs=False)
+  def __init__(self, departments, aisles, items, orders, dept_orders, total_orders):
+    self.departments = list(departments)
+    self.aisles = list(aisles)
+    self._dept_index = {name: i for i, name in enumerate(self.departments)}
+    self._aisle_index = {name: i for i, name in enumerate(self.aisles)}
+    self.items = items                # [D, A, 7, 24]
+    self.orders = orders              # [D, A, 7, 24]
+    # every Instacart aisle sits in exactly one department, so summing over departments
+    # picks up a single row per aisle and the order counts stay exact
+    self.aisle_items = items.sum(axis=0)    # [A, 7, 24]
+    self.aisle_orders = orders.sum(axis=0)  # [A, 7, 24]
+    self.dept_items = items.sum(axis=1)  # [D, 7, 24]
+    self.dept_orders = dept_orders    # [D, 7, 24]
+    self.total_items = self.dept_items.sum(axis=0)  # [7, 24]
+    self.total_orders = total_orders  # [7, 24]
+    self._labels = {'department': np.array(self.departments, dtype=object), 'aisle': np.array(self.aisles, dtype=object),
+                    'dow': np.arange(7), 'hour': np.arange(24)}
+    # aisles that actually hold products for each department (the dense grid is mostly empty)
+    self.aisles_by_department = {
+      d: [self.aisles[a] for a in np.flatnonzero(items[i].sum(axis=(1, 2)))]
+      for i, d in enumerate(self.departments)
+    }
+
+  @classmethod
+  def build(cls, snapshot=None):
+    departments = list(run_query('departments', snapshot).itertuples(index=False, name=None))
+    aisles = list(run_query('aisles', snapshot).itertuples(index=False, name=None))
+    dept_pos = {dept_id: i for i, (dept_id, _) in enumerate(departments)}
+    aisle_pos = {aisle_id: i for i, (aisle_id, _) in enumerate(aisles)}
+    shape = (len(departments), len(aisles), 7, 24)
+    items = np.zeros(shape, dtype=np.int64)
+    orders = np.zeros(shape, dtype=np.int64)
+    dept_orders = np.zeros(shape[:1] + shape[2:], dtype=np.int64)
+    total_orders = np.zeros(shape[2:], dtype=np.int64)
+
+    df = run_query('demand_cube', snapshot)
+    if not df.empty:
+      df = df.dropna(subset=['order_dow', 'order_hour_of_day'])
+      # grp bits: 0 = dept+aisle cell, 1 = department roll-up, 3 = overall
+      cells = df[(df['grp'] == 0) & df['department_id'].isin(dept_pos) & df['aisle_id'].isin(aisle_pos)]
+      idx = (cells['department_id'].map(dept_pos).to_numpy(), cells['aisle_id'].map(aisle_pos).to_numpy(),
+             cells['order_dow'].to_numpy(dtype=int), cells['order_hour_of_day'].to_numpy(dtype=int))
+      items[idx] = cells['items'].to_numpy()
+      orders[idx] = cells['orders'].to_numpy()
+      dept = df[(df['grp'] == 1) & df['department_id'].isin(dept_pos)]
+      dept_orders[(dept['department_id'].map(dept_pos).to_numpy(), dept['order_dow'].to_numpy(dtype=int),
+                   dept['order_hour_of_day'].to_numpy(dtype=int))] = dept['orders'].to_numpy()
+      total = df[df['grp'] == 3]
+      total_orders[(total['order_dow'].to_numpy(dtype=int), total['order_hour_of_day'].to_numpy(dtype=int))] = total['orders'].to_numpy()
+
+    return cls([name for _, name in departments], [name for _, name in aisles], items, orders, dept_orders, total_orders)
+
+  def _resolve(self, department=None, aisle=None):
+    d = a = None
+    if department:
+      if department not in self._dept_index:
+        raise KeyError(f'unknown department: {department}')
+      d = self._dept_index[department]
+    if aisle:
+      if aisle not in self._aisle_index:
+        raise KeyError(f'unknown aisle: {aisle}')
+      a = self._aisle_index[aisle]
+    return d, a
+
+  def grid(self, department=None, aisle=None):
+    """Return (items, orders) as 7x24 arrays for an optional department/aisle filter."""
+    d, a = self._resolve(department, aisle)
+    if a is not None:
+      if d is not None:
+        return self.items[d, a], self.orders[d, a]
+      return self.aisle_items[a], self.aisle_orders[a]
+    if d is not None:
+      return self.dept_items[d], self.dept_orders[d]
+    return self.total_items, self.total_orders
+
+  def drill(self, by=('dow', 'hour'), department=None, aisle=None, dow=None, hour=None):
+    """Roll the cube up to the `by` dimensions after applying the filters.
+
+    Returns a list of records, one per group, with the `by` keys plus `items` and `orders`.
+    Grouping by department or aisle drills into the per-department / per-aisle grids, so
+    order counts stay exact; department/aisle groups with no items are left out, while the
+    dow/hour axes are always dense (empty slots come back as zeros).
+    """
+    by = [b for b in self.DIMENSIONS if b in by]
+    d, a = self._resolve(department, aisle)
+    if dow is not None and not 0 <= dow < 7:
+      raise IndexError(f'dow out of range: {dow}')
+    if hour is not None and not 0 <= hour < 24:
+      raise IndexError(f'hour out of range: {hour}')
+
+    # pick the finest precomputed grid the request needs, so a department or aisle axis is
+    # only ever grouped or filtered, never summed across (which would double count orders)
+    use_aisle = 'aisle' in by or a is not None
+    use_dept = 'department' in by or d is not None
+    if use_aisle and use_dept:
+      items, orders, axes = self.items, self.orders, [('department', d), ('aisle', a)]
+    elif use_aisle:
+      items, orders, axes = self.aisle_items, self.aisle_orders, [('aisle', a)]
+    elif use_dept:
+      items, orders, axes = self.dept_items, self.dept_orders, [('department', d)]
     else:
-        figs['q2_hour'] = '<div class="alert alert-warning">No data for Q2 (hour)</div>'
-
-    # Q3
-    if not q3_df.empty:
-        q3_plot = q3_df.head(20)
-        q3_plot['pair'] = q3_plot['product_A'] + ' + ' + q3_plot['product_B']
-        fig3 = px.bar(q3_plot.iloc[::-1], x='times_bought_together', y='pair', orientation='h', title='Top product pairs bought together')
-        figs['q3'] = pio.to_html(fig3, full_html=False, include_plotlyjs=False)
+      items, orders, axes = self.total_items, self.total_orders, []
+    axes += [('dow', dow), ('hour', hour)]
+
+    # basic indexing only (views, no copies): an int drops a filtered axis, a length-1 slice
+    # keeps a filtered axis that is also grouped on
+    index, kept = [], []
+    for name, pos in axes:
+      if pos is None:
+        index.append(slice(None))
+      elif name in by:
+        index.append(slice(pos, pos + 1))
+      else:
+        index.append(pos)
+        continue
+      kept.append((name, pos))
+    items, orders = items[tuple(index)], orders[tuple(index)]
+    drop = tuple(i for i, (name, _) in enumerate(kept) if name not in by)
+    if drop:
+      items, orders = items.sum(axis=drop), orders.sum(axis=drop)
+    if not by:
+      return [{'items': int(items), 'orders': int(orders)}]
+
+    groups = [(name, pos) for name, pos in kept if name in by]
+    # the dense grid holds every department x aisle pair; only report populated ones, but keep
+    # every dow/hour slot for them so the output shape does not depend on the filters
+    time_axes = tuple(i for i, (name, _) in enumerate(groups) if name in ('dow', 'hour'))
+    if len(time_axes) < len(groups):
+      populated = items.sum(axis=time_axes, keepdims=True) > 0
+      cells = np.nonzero(np.broadcast_to(populated, items.shape))
     else:
-        figs['q3'] = '<div class="alert alert-warning">No data for Q3</div>'
-
-    # Q4
-    if not q4_df.empty:
-        import plotly.graph_objects as go
-        fig4 = go.Figure()
-        fig4.add_trace(go.Bar(x=q4_df['customer_segment'], y=q4_df['avg_reorder_rate'], name='Avg reorder rate', marker_color='skyblue', yaxis='y1'))
-        fig4.add_trace(go.Scatter(x=q4_df['customer_segment'], y=q4_df['num_customers'], name='Number of customers', marker_color='blue', yaxis='y2'))
-        fig4.update_layout(title='Reorder rate and number of customers by segment', yaxis=dict(title='Avg reorder rate'), yaxis2=dict(title='Number of customers', overlaying='y', side='right'))
-        figs['q4'] = pio.to_html(fig4, full_html=False, include_plotlyjs=False)
+      cells = np.unravel_index(np.arange(items.size), items.shape)
+    columns = [self._labels[name][idx + (pos or 0)].tolist() for (name, pos), idx in zip(groups, cells)]
+    columns += [items[cells].tolist(), orders[cells].tolist()]
+    keys = by + ['items', 'orders']
+    return [dict(zip(keys, row)) for row in zip(*columns)]
+
+
+_demand_cubes = {}  # snapshot version -> DemandCube
+_demand_cube_lock = threading.Lock()
+
+
+def get_demand_cube(snapshot=None):
+  """Return the demand cube for a snapshot, building it once per data version."""
+  if snapshot is None:
+    if has_request_context():
+      snapshot = request_snapshot()
     else:
-        figs['q4'] = '<div class="alert alert-warning">No data for Q4</div>'
+      with held_snapshot() as snapshot:
+        return get_demand_cube(snapshot)
+  cube = _demand_cubes.get(snapshot.version)
+  if cube is None:
+    with _demand_cube_lock:
+      cube = _demand_cubes.get(snapshot.version)
+      if cube is None:
+        cube = _demand_cubes[snapshot.version] = DemandCube.build(snapshot)
+        # keep only the cube being built and the one being served
+        live = {snapshot.version, _snapshot.version if _snapshot else None}
+        for version in [v for v in _demand_cubes if v not in live]:
+          del _demand_cubes[version]
+  return cube
+
+
+@app.route('/')
+def index():
+    # Render the general introduction dashboard as the main page
+    return general_dashboard()
+
+
+# --- General dashboard panels ---
+# Each panel runs its own catalog query on the given snapshot (the same queries as /api/q1..q4,
+# so dashboard and API requests coalesce) and returns a Plotly figure, or None when there is no data.
+def _panel_q1(snapshot):
+    # Q1: top 10 products by reorder_rate
+    q1_df = run_query('q1_top_reorder_products', snapshot)
+    if q1_df.empty:
+        return None
+    q1_plot = q1_df.sort_values('reorder_rate', ascending=False).head(10)
+    return px.bar(q1_plot, x='reorder_rate', y='product_name', orientation='h', color='department', title='Top 10 products by repeat purchase rate')
+
+
+def _panel_q2_day(snapshot):
+    q2_day_df = run_query('q2_items_by_day', snapshot)
+    if q2_day_df.empty:
+        return None
+    return px.bar(q2_day_df, x='day_name', y='total_items', title='Ordering activity by day of week')
+
+
+def _panel_q2_hour(snapshot):
+    q2_hour_df = run_query('q2_items_by_hour', snapshot)
+    if q2_hour_df.empty:
+        return None
+    return px.line(q2_hour_df, x='hour_of_day', y='total_items', title='Ordering activity by hour of day')
+
+
+def _panel_q3(snapshot):
+    q3_df = run_query('q3_top_pairs', snapshot)
+    if q3_df.empty:
+        return None
+    q3_plot = q3_df.head(20).copy()
+    q3_plot['pair'] = q3_plot['product_A'] + ' + ' + q3_plot['product_B']
+    return px.bar(q3_plot.iloc[::-1], x='times_bought_together', y='pair', orientation='h', title='Top product pairs bought together')
+
+
+def _panel_q4(snapshot):
+    q4_df = run_query('q4_frequency_segments', snapshot)
+    if q4_df.empty:
+        return None
+    fig4 = go.Figure()
+    fig4.add_trace(go.Bar(x=q4_df['customer_segment'], y=q4_df['avg_reorder_rate'], name='Avg reorder rate', marker_color='skyblue', yaxis='y1'))
+    fig4.add_trace(go.Scatter(x=q4_df['customer_segment'], y=q4_df['num_customers'], name='Number of customers', marker_color='blue', yaxis='y2'))
+    fig4.update_layout(title='Reorder rate and number of customers by segment', yaxis=dict(title='Avg reorder rate'), yaxis2=dict(title='Number of customers', overlaying='y', side='right'))
+    return fig4
+
+
+# (panel id, builder, message when empty); ids match the slots in general_dashboard.html
+DASHBOARD_PANELS = [
+    ('q1', _panel_q1, 'No data for Q1'),
+    ('q2_day', _panel_q2_day, 'No data for Q2 (day)'),
+    ('q2_hour', _panel_q2_hour, 'No data for Q2 (hour)'),
+    ('q3', _panel_q3, 'No data for Q3'),
+    ('q4', _panel_q4, 'No data for Q4'),
+]
+
+# The Q3 pairs join takes far longer than the other panels. It gets its own pool so a burst of
+# dashboard loads waiting on it cannot occupy the threads the fast panels need; the fast pool
+# has room for every fast panel of 8 concurrent loads.
+SLOW_PANELS = {'q3'}
+_panel_pool = ThreadPoolExecutor(max_workers=8 * (len(DASHBOARD_PANELS) - len(SLOW_PANELS)), thread_name_prefix='dashboard-panel')
+_slow_panel_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix='dashboard-panel-slow')
+
+
+def _timed_panel(builder, snapshot):
+    started = time.perf_counter()
+    fig = builder(snapshot)
+    # serialise in the worker too, so the streaming thread only writes bytes
+    fig_json = pio.to_json(fig) if fig is not None else None
+    return fig_json, (time.perf_counter() - started) * 1000
+
 
-    return render_template('general_dashboard.html', plots=figs)
+def _stream_dashboard_panels(snapshot):
+    """Yield one <script> chunk per panel, in the order the panels finish.
+
+    Panels run on worker threads without a request context, so they are handed the
+    request's snapshot explicitly (each with its own hold); all five read the same data version.
+    """
+    started = time.perf_counter()
+    futures = {}
+    for panel_id, builder, empty in DASHBOARD_PANELS:
+        pool = _slow_panel_pool if panel_id in SLOW_PANELS else _panel_pool
+        # each task holds the snapshot itself, so a stream abandoned mid-way cannot close the
+        # connection under a panel that is still running
+        snapshot.share()
+        future = pool.submit(_timed_panel, builder, snapshot)
+        future.add_done_callback(lambda _: snapshot.release())
+        futures[future] = (panel_id, empty)
+    try:
+        for future in as_completed(futures):
+            panel_id, empty = futures[future]
+            try:
+                fig_json, compute_ms = future.result()
+                message = None if fig_json is not None else empty
+            except Exception:
+                app.logger.exception('Dashboard panel %s failed', panel_id)
+                fig_json, compute_ms, message = None, None, f'Could not load {panel_id}'
+            ready_ms = (time.perf_counter() - started) * 1000
+            # `</` would end the inline script early
+            figure = (fig_json or 'null').replace('</', '<\\/')
+            yield (f'<script>renderPanel({json.dumps(panel_id)}, {figure}, {json.dumps(message)}, '
+                   f'{json.dumps(ready_ms)}, {json.dumps(compute_ms)});</script>\n')
+    finally:
+        # the client went away (the generator was closed): drop panels still queued so they do
+        # not take pool threads from live requests; running ones finish and release their hold
+        for future in futures:
+            future.cancel()
+
+
+@app.route('/general_dashboard')
+def general_dashboard():
+    # Send the shell straight away, then each panel's figure as soon as it is ready, so the
+    # page paints at the pace of the fastest panel rather than the slowest.
+    debug = app.debug or str(request.args.get('debug', '')).lower() in ('1', 'true', 'yes')
+    snapshot = request_snapshot()
+    body = stream_template('general_dashboard.html', panel_scripts=_stream_dashboard_panels(snapshot), debug=debug)
+    # ask reverse proxies not to buffer the chunked response
+    response = app.response_class(body, mimetype='text/html', headers={'X-Accel-Buffering': 'no'})
+    # the request's own hold can end when this view returns; keep the snapshot until the
+    # stream has been sent (or abandoned)
+    snapshot.share()
+    response.call_on_close(snapshot.release)
+    return response
 
 @app.route('/q1')
 def q1():
-    con = get_con()
-    qry = """
-    WITH product_stats AS (
-      SELECT p.product_name, d.department,
-             COUNT(*) AS total_orders,
-             SUM(op.reordered) AS total_reorders,
-             SUM(op.reordered)::DOUBLE / NULLIF(COUNT(*),0) AS reorder_rate
-      FROM fact_order_products op
-      JOIN dim_product p ON op.product_id = p.product_id
-      JOIN dim_department d ON p.department_id = d.department_id
-      GROUP BY 1,2
-      HAVING COUNT(*) >= 50
-    )
-    SELECT product_name, department, reorder_rate, total_orders
-    FROM product_stats
-    ORDER BY reorder_rate DESC
-    LIMIT 20;
-    """
-    df = con.execute(qry).fetchdf()
-    con.close()
+    df = run_query('q1_reorder_stats')
     if df.empty:
       table_html = 'No data found. Load DuckDB DB first.'
       plot_html = ''
@@ -256,51 +937,42 @@ def q1():
 
 @app.route('/q2')
 def q2():
-    con = get_con()
-    qry = """
-    SELECT order_dow, order_hour_of_day, COUNT(*) AS orders
-    FROM dim_order
-    GROUP BY 1,2
-    ORDER BY orders DESC
-    LIMIT 100;
-    """
-    df = con.execute(qry).fetchdf()
-    con.close()
-    if df.empty:
-      table_html = 'No data found. Load DuckDB DB first.'
+    # Rendered from the in-memory demand cube; optional ?department=&aisle=&metric=orders|items filters
+    cube = get_demand_cube()
+    department = request.args.get('department') or None
+    aisle = request.args.get('aisle') or None
+    metric = request.args.get('metric', 'orders')
+    if metric not in ('orders', 'items'):
+      metric = 'orders'
+    try:
+      items, orders = cube.grid(department=department, aisle=aisle)
+    except KeyError as exc:
+      items = orders = None
+      table_html = f'No data: {Markup.escape(exc.args[0])}.'
       plot_html = ''
-    else:
-      fig = px.density_heatmap(df, x='order_hour_of_day', y='order_dow', z='orders', nbinsx=24, nbinsy=7,
-                   title='Orders: hour of day vs day of week', labels={'order_hour_of_day':'Hour','order_dow':'Day of week'})
-      plot_html = pio.to_html(fig, full_html=False)
-      table_html = df_to_formatted_html(df)
+    if items is not None:
+      values = orders if metric == 'orders' else items
+      if not values.any():
+        table_html = 'No data found. Load DuckDB DB first.' if department is None and aisle is None else 'No orders for this selection.'
+        plot_html = ''
+      else:
+        grid = pd.DataFrame(values, index=DAY_NAMES, columns=range(24))
+        scope = ' / '.join(x for x in (department, aisle) if x) or 'all departments'
+        fig = px.imshow(grid, aspect='auto', labels={'x':'Hour', 'y':'Day of week', 'color':metric.capitalize()},
+                        title=f'{metric.capitalize()}: hour of day vs day of week ({scope})')
+        plot_html = pio.to_html(fig, full_html=False)
+        df = pd.DataFrame({'dow': np.repeat(np.arange(7), 24), 'day_name': np.repeat(DAY_NAMES, 24),
+                           'hour': np.tile(np.arange(24), 7), 'items': items.ravel(), 'orders': orders.ravel()})
+        table_html = df_to_formatted_html(df.sort_values(metric, ascending=False))
 
     partial = str(request.args.get('partial', '')).lower() in ('1', 'true', 'yes')
-    return render_template('q2.html', plot_div=Markup(plot_html), table_html=Markup(table_html), partial=partial)
+    return render_template('q2.html', plot_div=Markup(plot_html), table_html=Markup(table_html), partial=partial,
+                           departments=cube.departments, aisles_by_department=cube.aisles_by_department,
+                           department=department, aisle=aisle, metric=metric)
 
 @app.route('/q3')
 def q3():
-    con = get_con()
-    qry = """
-    WITH pairs AS (
-      SELECT LEAST(p1.product_name, p2.product_name) AS product_a,
-             GREATEST(p1.product_name, p2.product_name) AS product_b,
-             COUNT(*) AS pair_count
-      FROM fact_order_products op1
-      JOIN fact_order_products op2
-        ON op1.order_id = op2.order_id
-       AND op1.product_id < op2.product_id
-      JOIN dim_product p1 ON op1.product_id = p1.product_id
-      JOIN dim_product p2 ON op2.product_id = p2.product_id
-      GROUP BY 1,2
-    )
-    SELECT *
-    FROM pairs
-    ORDER BY pair_count DESC
-    LIMIT 50;
-    """
-    df = con.execute(qry).fetchdf()
-    con.close()
+    df = run_query('q3_all_pairs')
     if df.empty:
       table_html = 'No data found. Load DuckDB DB first.'
       plot_html = ''
@@ -317,34 +989,7 @@ def q3():
 
 @app.route('/q4')
 def q4():
-    con = get_con()
-    qry = """
-    WITH order_sizes AS (
-      SELECT o.user_id, o.order_id, COUNT(*) AS basket_size
-      FROM dim_order o
-      JOIN fact_order_products op ON o.order_id = op.order_id
-      GROUP BY 1,2
-    ),
-    user_segments AS (
-      SELECT user_id, AVG(basket_size) AS avg_basket,
-             CASE WHEN AVG(basket_size) < 8 THEN 'small'
-                  WHEN AVG(basket_size) BETWEEN 8 AND 15 THEN 'medium'
-                  ELSE 'large' END AS segment
-      FROM order_sizes
-      GROUP BY 1
-    ),
-    user_reorder AS (
-      SELECT u.segment, COUNT(*) AS total_items, SUM(op.reordered) AS total_reorders,
-             SUM(op.reordered)::DOUBLE / NULLIF(COUNT(*),0) AS reorder_rate
-      FROM user_segments u
-      JOIN dim_order o ON u.user_id = o.user_id
-      JOIN fact_order_products op ON o.order_id = op.order_id
-      GROUP BY 1
-    )
-    SELECT * FROM user_reorder ORDER BY segment;
-    """
-    df = con.execute(qry).fetchdf()
-    con.close()
+    df = run_query('q4_basket_segments')
     if df.empty:
       table_html = 'No data found. Load DuckDB DB first.'
       plot_html = ''
@@ -358,31 +1003,7 @@ def q4():
 
 @app.route('/q5')
 def q5():
-    con = get_con()
-    qry = """
-    WITH recency AS (
-      SELECT user_id, order_id, order_number, days_since_prior_order
-      FROM dim_order
-      WHERE days_since_prior_order IS NOT NULL
-    ),
-    summary AS (
-      SELECT AVG(days_since_prior_order) AS avg_days, MEDIAN(days_since_prior_order) AS median_days FROM recency
-    ),
-    by_dow AS (
-      SELECT order_dow, AVG(days_since_prior_order) AS avg_days FROM dim_order WHERE days_since_prior_order IS NOT NULL GROUP BY order_dow
-    ),
-    by_hour AS (
-      SELECT order_hour_of_day, AVG(days_since_prior_order) AS avg_days FROM dim_order WHERE days_since_prior_order IS NOT NULL GROUP BY order_hour_of_day
-    )
-    SELECT 'overall' AS slice, * FROM summary
-    UNION ALL
-    SELECT 'by_dow:' || order_dow AS slice, avg_days AS avg_days, NULL AS median_days FROM by_dow
-    UNION ALL
-    SELECT 'by_hour:' || order_hour_of_day AS slice, avg_days AS avg_days, NULL AS median_days FROM by_hour
-    ORDER BY slice;
-    """
-    df = con.execute(qry).fetchdf()
-    con.close()
+    df = run_query('q5_recency')
     if df.empty:
       table_html = 'No data found. Load DuckDB DB first.'
     else:
@@ -395,173 +1016,65 @@ def q5():
 # --- JSON API endpoints for client-side rendering ---
 @app.route('/api/q1')
 def api_q1():
-    con = get_con()
     # Q1: Customer loyalty and product performance
     # Which products and departments show the highest rates of repeat purchases?
-    qry = """
-    SELECT
-      p.product_id, p.product_name, d.department, a.aisle, COUNT(*) AS total_items,
-      AVG(CASE WHEN f.reordered = 1 THEN 1.0 ELSE 0.0 END) AS reorder_rate
-    FROM fact_order_products f
-    JOIN dim_product p    ON f.product_id = p.product_id
-    JOIN dim_department d ON p.department_id = d.department_id
-    JOIN dim_aisles a ON a.aisle_id = p.aisle_id
-    GROUP BY p.product_id, p.product_name, d.department, a.aisle
-    HAVING COUNT(*) > 100
-    ORDER BY reorder_rate DESC, total_items DESC
-    LIMIT 20;
-    """
-    df = con.execute(qry).fetchdf()
-    con.close()
+    df = run_query('q1_top_reorder_products')
     return jsonify(columns=df.columns.tolist(), records=df.fillna('').to_dict(orient='records'))
 
 
 @app.route('/api/q2')
 def api_q2():
-    con = get_con()
-    # Q2: Demand over time and staff scheduling
-    # Day-level aggregation
-    qry_day = """
-    SELECT 
-      o.order_dow AS day_of_week,
-      CASE 
-        WHEN o.order_dow = 0 THEN 'Sunday'
-        WHEN o.order_dow = 1 THEN 'Monday'
-        WHEN o.order_dow = 2 THEN 'Tuesday'
-        WHEN o.order_dow = 3 THEN 'Wednesday'
-        WHEN o.order_dow = 4 THEN 'Thursday'
-        WHEN o.order_dow = 5 THEN 'Friday'
-        WHEN o.order_dow = 6 THEN 'Saturday'
-      END AS day_name,
-      COUNT(*) AS total_items
-    FROM fact_order_products f
-    JOIN dim_order o 
-      ON f.order_id = o.order_id
-    GROUP BY o.order_dow
-    ORDER BY o.order_dow;
-    """
-
-    # Hour-level aggregation
-    qry_hour = """
-    SELECT
-      o.order_hour_of_day AS hour_of_day,
-      COUNT(*) AS total_items
-    FROM fact_order_products f
-    JOIN dim_order o ON f.order_id = o.order_id
-    GROUP BY o.order_hour_of_day
-    ORDER BY o.order_hour_of_day;
-    """
-
-    df_day = con.execute(qry_day).fetchdf()
-    df_hour = con.execute(qry_hour).fetchdf()
-    con.close()
+    # Q2: Demand over time and staff scheduling (day- and hour-level aggregation)
+    df_day = run_query('q2_items_by_day')
+    df_hour = run_query('q2_items_by_hour')
     # return both day and hour data together
     return jsonify(day_columns=df_day.columns.tolist(), day_records=df_day.fillna(0).to_dict(orient='records'),
                    hour_columns=df_hour.columns.tolist(), hour_records=df_hour.fillna(0).to_dict(orient='records'))
 
 
+@app.route('/api/q2/cube')
+def api_q2_cube():
+    # Drill-down / roll-up over the demand cube, e.g.
+    # /api/q2/cube?by=department,dow&aisle=fresh%20fruits&hour=10
+    cube = get_demand_cube()
+    by = [b for b in request.args.get('by', 'dow,hour').split(',') if b]
+    unknown = [b for b in by if b not in DemandCube.DIMENSIONS]
+    if unknown:
+      return jsonify(error=f"unknown dimension(s): {', '.join(unknown)}", dimensions=list(DemandCube.DIMENSIONS)), 400
+    filters = {}
+    for key, upper in (('dow', 7), ('hour', 24)):
+      raw = request.args.get(key)
+      if raw in (None, ''):
+        continue
+      try:
+        filters[key] = int(raw)
+      except ValueError:
+        return jsonify(error=f'{key} must be an integer between 0 and {upper - 1}: {raw}'), 400
+    try:
+      records = cube.drill(by=by, department=request.args.get('department') or None,
+                           aisle=request.args.get('aisle') or None, **filters)
+    except (KeyError, IndexError) as exc:
+      return jsonify(error=exc.args[0]), 400
+    return jsonify(columns=[b for b in DemandCube.DIMENSIONS if b in by] + ['items', 'orders'], records=records)
+
+
 @app.route('/api/q3')
 def api_q3():
-    con = get_con()
     # Q3: Products that are purchased together (cross-selling)
-    qry = """
-    WITH top_products AS (
-      SELECT
-        product_id,
-        COUNT(*) AS total_items
-      FROM fact_order_products
-      GROUP BY product_id
-      ORDER BY total_items DESC
-      LIMIT 100
-    ),
-    filtered AS (
-      SELECT
-        f.order_id,
-        f.product_id
-      FROM fact_order_products f
-      JOIN top_products t USING (product_id)
-    )
-    SELECT
-      p1.product_name AS product_A,
-      p2.product_name AS product_B,
-      COUNT(*) AS times_bought_together
-    FROM filtered f1
-    JOIN filtered f2
-        ON f1.order_id = f2.order_id
-       AND f1.product_id < f2.product_id
-    JOIN dim_product p1 ON f1.product_id = p1.product_id
-    JOIN dim_product p2 ON f2.product_id = p2.product_id
-    GROUP BY product_A, product_B
-    ORDER BY times_bought_together DESC
-    LIMIT 20;
-    """
-    df = con.execute(qry).fetchdf()
-    con.close()
+    df = run_query('q3_top_pairs')
     return jsonify(columns=df.columns.tolist(), records=df.fillna('').to_dict(orient='records'))
 
 
 @app.route('/api/q4')
 def api_q4():
-    con = get_con()
     # Q4: Customer segments and repurchase behavior
-    qry = """
-    WITH customer_stats AS (
-      SELECT user_id, AVG(days_since_prior_order) AS avg_days_between_orders, COUNT(order_id) AS total_orders
-      FROM dim_order
-      WHERE days_since_prior_order IS NOT NULL
-      GROUP BY user_id
-    ),
-    segments AS (
-      SELECT
-        user_id, avg_days_between_orders, total_orders,
-        CASE
-          WHEN avg_days_between_orders <= 7 THEN 'High-frequency'
-          WHEN avg_days_between_orders BETWEEN 8 AND 20 THEN 'Medium-frequency'
-          ELSE 'Low-frequency'
-        END AS customer_segment
-      FROM customer_stats
-    )
-    SELECT
-      s.customer_segment, COUNT(DISTINCT s.user_id) AS num_customers, AVG(f.reordered) AS avg_reorder_rate,
-      AVG(s.avg_days_between_orders) AS avg_days_between_orders
-    FROM segments s
-    JOIN dim_order o             ON o.user_id = s.user_id
-    JOIN fact_order_products f   ON f.order_id = o.order_id
-    GROUP BY s.customer_segment
-    ORDER BY avg_reorder_rate DESC;
-    """
-    df = con.execute(qry).fetchdf()
-    con.close()
+    df = run_query('q4_frequency_segments')
     return jsonify(columns=df.columns.tolist(), records=df.fillna(0).to_dict(orient='records'))
 
 
 @app.route('/api/q5')
 def api_q5():
-    con = get_con()
-    qry = """
-    WITH recency AS (
-      SELECT user_id, order_id, order_number, days_since_prior_order
-      FROM dim_order
-      WHERE days_since_prior_order IS NOT NULL
-    ),
-    summary AS (
-      SELECT AVG(days_since_prior_order) AS avg_days, MEDIAN(days_since_prior_order) AS median_days FROM recency
-    ),
-    by_dow AS (
-      SELECT order_dow, AVG(days_since_prior_order) AS avg_days FROM dim_order WHERE days_since_prior_order IS NOT NULL GROUP BY order_dow
-    ),
-    by_hour AS (
-      SELECT order_hour_of_day, AVG(days_since_prior_order) AS avg_days FROM dim_order WHERE days_since_prior_order IS NOT NULL GROUP BY order_hour_of_day
-    )
-    SELECT 'overall' AS slice, * FROM summary
-    UNION ALL
-    SELECT 'by_dow:' || order_dow AS slice, avg_days AS avg_days, NULL AS median_days FROM by_dow
-    UNION ALL
-    SELECT 'by_hour:' || order_hour_of_day AS slice, avg_days AS avg_days, NULL AS median_days FROM by_hour
-    ORDER BY slice;
-    """
-    df = con.execute(qry).fetchdf()
-    con.close()
+    df = run_query('q5_recency')
     return jsonify(columns=df.columns.tolist(), records=df.fillna('').to_dict(orient='records'))
 
 
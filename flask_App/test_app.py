@@ -0,0 +1,395 @@
+import os
+import threading
+import time
+
+import duckdb
+import pytest
+
+import app as instacart
+
+
+# Two departments, three aisles (two in produce). Order 1 buys from both produce aisles, so
+# summing per-aisle distinct orders would count it twice.
+DEPARTMENTS = [(1, 'produce'), (2, 'dairy eggs')]
+AISLES = [(1, 'fresh fruits'), (2, 'fresh vegetables'), (3, 'milk')]
+PRODUCTS = [(1, 'Banana', 1, 1), (2, 'Apple', 1, 1), (3, 'Spinach', 2, 1), (4, 'Whole Milk', 3, 2)]
+ORDERS = [
+  # order_id, user_id, order_number, order_dow, order_hour_of_day, days_since_prior_order
+  (1, 1, 1, 0, 9, None),
+  (2, 1, 2, 0, 9, 7.0),
+  (3, 2, 1, 3, 14, None),
+  (4, 3, 1, 3, 9, 30.0),
+]
+ORDER_PRODUCTS = [
+  # order_id, product_id, add_to_cart_order, reordered
+  (1, 1, 1, 0), (1, 2, 2, 0), (1, 3, 3, 0),
+  (2, 1, 1, 1), (2, 4, 2, 0),
+  (3, 4, 1, 0), (3, 3, 2, 0),
+  (4, 2, 1, 0),
+]
+
+
+def make_db(path, extra_orders=0):
+  """Write the fixture star schema to `path`; `extra_orders` adds one-banana orders on Monday 10:00."""
+  con = duckdb.connect(str(path))
+  con.execute('CREATE TABLE dim_department(department_id INT, department VARCHAR)')
+  con.execute('CREATE TABLE dim_aisles(aisle_id INT, aisle VARCHAR)')
+  con.execute('CREATE TABLE dim_product(product_id INT, product_name VARCHAR, aisle_id INT, department_id INT)')
+  con.execute('CREATE TABLE dim_order(order_id INT, user_id INT, order_number INT, order_dow INT, order_hour_of_day INT, days_since_prior_order DOUBLE)')
+  con.execute('CREATE TABLE fact_order_products(order_id INT, product_id INT, add_to_cart_order INT, reordered INT)')
+  con.executemany('INSERT INTO dim_department VALUES (?, ?)', DEPARTMENTS)
+  con.executemany('INSERT INTO dim_aisles VALUES (?, ?)', AISLES)
+  con.executemany('INSERT INTO dim_product VALUES (?, ?, ?, ?)', PRODUCTS)
+  orders = ORDERS + [(100 + i, 9, 1, 1, 10, None) for i in range(extra_orders)]
+  con.executemany('INSERT INTO dim_order VALUES (?, ?, ?, ?, ?, ?)', orders)
+  order_products = ORDER_PRODUCTS + [(100 + i, 1, 1, 0) for i in range(extra_orders)]
+  con.executemany('INSERT INTO fact_order_products VALUES (?, ?, ?, ?)', order_products)
+  con.close()
+  return str(path)
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+  """Serve a fresh fixture database with empty snapshot state and caches."""
+  path = make_db(tmp_path / 'instacart.db')
+  monkeypatch.setattr(instacart, 'DB_PATH', path)
+  monkeypatch.setattr(instacart, 'SNAPSHOT_DIR', str(tmp_path / 'snapshots'))
+  monkeypatch.setattr(instacart, 'SNAPSHOT_POINTER', str(tmp_path / 'snapshots' / 'CURRENT'))
+  monkeypatch.setattr(instacart, '_snapshot', None)
+  monkeypatch.setattr(instacart, '_snapshot_checked_at', 0.0)
+  monkeypatch.setattr(instacart, '_snapshot_pending', None)
+  monkeypatch.setattr(instacart, '_snapshot_failed', {})
+  monkeypatch.setattr(instacart, 'SNAPSHOT_POLL_SECONDS', 0.01)
+  monkeypatch.setattr(instacart, '_demand_cubes', {})
+  return path
+
+
+def sql_counts(path, by, filters):
+  columns = {'department': 'd.department', 'aisle': 'a.aisle', 'dow': 'o.order_dow', 'hour': 'o.order_hour_of_day'}
+  where = ' AND '.join(f'{columns[k]} = ?' for k in filters) or 'TRUE'
+  group = ', '.join(columns[b] for b in by)
+  qry = f"""
+    SELECT {group + ',' if group else ''} COUNT(*) AS items, COUNT(DISTINCT f.order_id) AS orders
+    FROM fact_order_products f
+    JOIN dim_order o      ON f.order_id = o.order_id
+    JOIN dim_product p    ON f.product_id = p.product_id
+    JOIN dim_department d ON p.department_id = d.department_id
+    JOIN dim_aisles a     ON p.aisle_id = a.aisle_id
+    WHERE {where}
+    {'GROUP BY ' + group if group else ''}
+  """
+  con = duckdb.connect(path, read_only=True)
+  try:
+    return sorted(tuple(row) for row in con.execute(qry, list(filters.values())).fetchall() if row[-2])
+  finally:
+    con.close()
+
+
+@pytest.mark.parametrize('by', [
+  (), ('department',), ('aisle',), ('dow',), ('hour',), ('dow', 'hour'),
+  ('department', 'hour'), ('department', 'aisle'), ('aisle', 'dow', 'hour'),
+])
+@pytest.mark.parametrize('filters', [
+  {}, {'department': 'produce'}, {'aisle': 'fresh fruits'}, {'dow': 0}, {'department': 'produce', 'hour': 9},
+])
+def test_drill_matches_sql(db, by, filters):
+  cube = instacart.get_demand_cube()
+  got = sorted(tuple(r[b] for b in by) + (r['items'], r['orders']) for r in cube.drill(by=by, **filters) if r['items'])
+  assert got == sql_counts(db, by, filters)
+
+
+def test_department_orders_are_not_summed_across_aisles(db):
+  cube = instacart.get_demand_cube()
+  # order 1 bought from both produce aisles at Sunday 9:00
+  assert cube.drill(by=(), department='produce', dow=0, hour=9) == [{'items': 4, 'orders': 2}]
+
+
+@pytest.mark.parametrize('query, expected', [
+  ('department=produce', 7 * 24),
+  ('department=dairy eggs&dow=6', 24),
+  ('aisle=milk&by=department,dow', 7),
+  ('department=produce&by=aisle,hour', 2 * 24),
+  ('by=department,aisle,dow', 3 * 7),
+])
+def test_cube_api_keeps_dow_and_hour_dense(db, query, expected):
+  client = instacart.app.test_client()
+  records = client.get(f'/api/q2/cube?{query}').get_json()['records']
+  assert len(records) == expected
+
+
+def test_cube_api_rejects_bad_filters(db):
+  client = instacart.app.test_client()
+  assert client.get('/api/q2/cube?dow=x').status_code == 400
+  assert client.get('/api/q2/cube?hour=24').status_code == 400
+  assert client.get('/api/q2/cube?by=week').status_code == 400
+  assert b'unknown department: nope' in client.get('/q2?department=nope').data
+
+
+def run_concurrently(fn, n=8):
+  """Call `fn` from `n` threads released together; return (results, errors)."""
+  barrier = threading.Barrier(n)
+  results, errors = [], []
+
+  def worker():
+    barrier.wait()
+    try:
+      results.append(fn())
+    except Exception as exc:
+      errors.append(exc)
+
+  threads = [threading.Thread(target=worker) for _ in range(n)]
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  return results, errors
+
+
+@pytest.fixture
+def slow_connect(db, monkeypatch):
+  """Count snapshot connections and hold each one open long enough for callers to pile up."""
+  calls = []
+  connect = instacart.Snapshot.connect
+  # publish and open the first snapshot before counting
+  instacart.get_snapshot()
+
+  def counting_connect(self):
+    calls.append(self.version)
+    time.sleep(0.3)
+    return connect(self)
+
+  monkeypatch.setattr(instacart.Snapshot, 'connect', counting_connect)
+  return calls
+
+
+def test_concurrent_run_query_executes_once(db, slow_connect):
+  results, errors = run_concurrently(lambda: instacart.run_query('q2_items_by_day'))
+  assert not errors
+  assert len(slow_connect) == 1
+  assert all(df.equals(results[0]) for df in results)
+  # every caller gets its own frame
+  assert len({id(df) for df in results}) == len(results)
+
+
+def test_concurrent_run_query_shares_exception(db, slow_connect, monkeypatch):
+  monkeypatch.setitem(instacart.QUERIES, 'broken', 'SELECT * FROM no_such_table;')
+  results, errors = run_concurrently(lambda: instacart.run_query('broken'))
+  assert not results
+  assert len(errors) == 8 and all(isinstance(e, duckdb.CatalogException) for e in errors)
+  assert len(slow_connect) == 1
+  # nothing is left in flight, so the next call executes again
+  with pytest.raises(duckdb.CatalogException):
+    instacart.run_query('broken')
+  assert len(slow_connect) == 2
+
+
+def wait_for(condition, timeout=5.0):
+  deadline = time.monotonic() + timeout
+  while not condition():
+    assert time.monotonic() < deadline, 'timed out'
+    instacart.get_snapshot()
+    time.sleep(0.02)
+
+
+def totals(client):
+  return client.get('/api/q2/cube?by=').get_json()['records'][0]
+
+
+def test_publish_switches_to_new_data(db, tmp_path):
+  client = instacart.app.test_client()
+  assert totals(client) == {'items': 8, 'orders': 4}
+  first = instacart.get_snapshot()
+
+  version = instacart.publish_snapshot(make_db(tmp_path / 'rebuilt.db', extra_orders=5))
+  wait_for(lambda: instacart.get_snapshot().version == version)
+  assert totals(client) == {'items': 13, 'orders': 9}
+  # the old snapshot's connection is closed once nothing holds it
+  wait_for(lambda: first._con is None)
+
+
+def test_db_path_is_not_held_open(db):
+  client = instacart.app.test_client()
+  assert totals(client)['items'] == 8
+  # serving reads a published copy, so an ingest job can still rewrite DB_PATH in place
+  con = duckdb.connect(db)
+  con.execute('DELETE FROM fact_order_products')
+  con.close()
+  assert os.listdir(instacart.SNAPSHOT_DIR)
+
+
+def test_first_snapshot_is_published_once(db):
+  results, errors = run_concurrently(instacart.get_snapshot)
+  assert not errors
+  assert len({s.version for s in results}) == 1
+  assert [f for f in os.listdir(instacart.SNAPSHOT_DIR) if f.endswith('.db')] == [f'{results[0].version}.db']
+  # opened before it was made current
+  assert results[0]._con is not None
+  assert instacart.publish_snapshot(db, if_missing=True) is None
+
+
+def test_request_reads_one_snapshot_across_a_switch(db, tmp_path):
+  with instacart.app.test_request_context('/'):
+    held = instacart.request_snapshot()
+    before = instacart.run_query('q2_items_by_hour')
+    version = instacart.publish_snapshot(make_db(tmp_path / 'rebuilt.db', extra_orders=5))
+    wait_for(lambda: instacart.get_snapshot().version == version)
+    # later queries in the same request still see the data version it started with
+    assert instacart.request_snapshot() is held
+    assert instacart.run_query('q2_items_by_hour').equals(before)
+    assert held._con is not None
+  wait_for(lambda: held._con is None)
+
+
+def test_failed_warm_is_retried(db, tmp_path, monkeypatch):
+  client = instacart.app.test_client()
+  assert totals(client)['items'] == 8
+  build = instacart.DemandCube.build
+  attempts = []
+
+  def flaky_build(snapshot=None):
+    attempts.append(snapshot.version)
+    if len(attempts) == 1:
+      raise RuntimeError('transient')
+    return build(snapshot)
+
+  monkeypatch.setattr(instacart.DemandCube, 'build', flaky_build)
+  version = instacart.publish_snapshot(make_db(tmp_path / 'rebuilt.db', extra_orders=5))
+  wait_for(lambda: instacart.get_snapshot().version == version)
+  assert attempts == [version, version]
+  assert totals(client)['items'] == 13
+
+
+def test_overlapping_publishes_switch_in_order(db, tmp_path, monkeypatch):
+  client = instacart.app.test_client()
+  assert totals(client)['items'] == 8
+  first = instacart.get_snapshot().version
+  build = instacart.DemandCube.build
+  warming, release = threading.Event(), threading.Event()
+
+  def slow_build(snapshot=None):
+    if not release.is_set():
+      warming.set()
+      release.wait(10)
+    return build(snapshot)
+
+  monkeypatch.setattr(instacart.DemandCube, 'build', slow_build)
+  try:
+    instacart.publish_snapshot(make_db(tmp_path / 'v2.db', extra_orders=5))
+    wait_for(warming.is_set)
+    newer = instacart.publish_snapshot(make_db(tmp_path / 'v3.db', extra_orders=9))
+  finally:
+    release.set()
+  seen = []
+
+  def switched():
+    seen.append(instacart.get_snapshot().version)
+    return seen[-1] == newer
+
+  wait_for(switched)
+  assert set(seen) <= {first, newer}
+  assert totals(client) == {'items': 17, 'orders': 13}
+  for _ in range(10):
+    assert instacart.get_snapshot().version == newer
+    time.sleep(0.02)
+
+
+def test_streamed_dashboard_holds_snapshot_until_sent(db):
+  client = instacart.app.test_client()
+  response = client.get('/', buffered=False)
+  snapshot = instacart.get_snapshot()
+  # Flask 2.x also keeps the request's own hold until the stream ends; 3.x releases it earlier
+  assert snapshot._holders >= 1
+  body = response.get_data()
+  response.close()
+  assert snapshot._holders == 0
+  assert body.count(b'<script>renderPanel(') == len(instacart.DASHBOARD_PANELS)
+
+
+def test_abandoned_stream_keeps_snapshot_for_running_panels(db, tmp_path, monkeypatch):
+  started, release = threading.Event(), threading.Event()
+  q3 = instacart._panel_q3
+  built = []
+
+  def blocked_q3(snapshot):
+    started.set()
+    release.wait(10)
+    built.append(q3(snapshot))
+
+  monkeypatch.setattr(instacart, 'DASHBOARD_PANELS',
+                      [(pid, blocked_q3 if pid == 'q3' else fn, empty) for pid, fn, empty in instacart.DASHBOARD_PANELS])
+  client = instacart.app.test_client()
+  response = client.get('/', buffered=False)
+  old = instacart.get_snapshot()
+  body = b''
+  chunks = iter(response.response)
+  fast = len(instacart.DASHBOARD_PANELS) - len(instacart.SLOW_PANELS)
+  while body.count(b'<script>renderPanel(') < fast:
+    body += next(chunks)
+  assert started.wait(5)
+  # the client goes away while Q3 is still running, and a new version is published
+  response.close()
+  version = instacart.publish_snapshot(make_db(tmp_path / 'rebuilt.db', extra_orders=5))
+  wait_for(lambda: instacart.get_snapshot().version == version)
+  assert old._con is not None
+  release.set()
+  wait_for(lambda: old._con is None)
+  assert built
+  time.sleep(0.1)
+  assert old._con is None
+  with pytest.raises(RuntimeError, match='retired'):
+    old.connect()
+
+
+def test_slow_panel_cannot_starve_fast_panels(db, monkeypatch):
+  release = threading.Event()
+  q3 = instacart._panel_q3
+
+  def blocked_q3(snapshot):
+    release.wait(10)
+    return q3(snapshot)
+
+  monkeypatch.setattr(instacart, 'DASHBOARD_PANELS',
+                      [(pid, blocked_q3 if pid == 'q3' else fn, empty) for pid, fn, empty in instacart.DASHBOARD_PANELS])
+  try:
+    with instacart.held_snapshot() as snapshot:
+      # more concurrent loads than the pools have threads, all stuck on Q3
+      streams = [instacart._stream_dashboard_panels(snapshot) for _ in range(12)]
+      fast = len(instacart.DASHBOARD_PANELS) - len(instacart.SLOW_PANELS)
+      for stream in streams:
+        chunks = [next(stream) for _ in range(fast)]
+        assert not any('"q3"' in chunk for chunk in chunks)
+      release.set()
+      for stream in streams:
+        assert '"q3"' in next(stream)
+  finally:
+    release.set()
+
+
+def test_closed_stream_cancels_queued_panels(db, monkeypatch):
+  release = threading.Event()
+  calls = []
+
+  def blocked_q3(snapshot):
+    calls.append(snapshot.version)
+    release.wait(10)
+
+  monkeypatch.setattr(instacart, 'DASHBOARD_PANELS',
+                      [(pid, blocked_q3 if pid == 'q3' else fn, empty) for pid, fn, empty in instacart.DASHBOARD_PANELS])
+  pool = instacart.ThreadPoolExecutor(max_workers=1)
+  monkeypatch.setattr(instacart, '_slow_panel_pool', pool)
+  try:
+    with instacart.held_snapshot() as snapshot:
+      first, second = (instacart._stream_dashboard_panels(snapshot) for _ in range(2))
+      fast = len(instacart.DASHBOARD_PANELS) - len(instacart.SLOW_PANELS)
+      for stream in (first, second):
+        for _ in range(fast):
+          next(stream)
+      # the first stream's Q3 has the only slow worker; the second's is still queued
+      second.close()
+      release.set()
+      assert '"q3"' in next(first)
+    wait_for(lambda: snapshot._holders == 0)
+    assert len(calls) == 1
+  finally:
+    release.set()
+    pool.shutdown()